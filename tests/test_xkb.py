@@ -1,14 +1,19 @@
 # NB these tests are intended to check whether the python bindings are
 # working, not whether libxkbcommon itself is working!
 
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
 from xkbcommon import xkb
 
 from tests.data import sample_keymap_string, sample_keymap_bytes
 
+import gc
 import os
+import subprocess
+import sys
 import tempfile
+import threading
+import weakref
 from io import BytesIO
 import array
 
@@ -18,15 +23,69 @@ testdir = os.path.dirname(os.path.abspath(__file__))
 nonexistent = os.path.join(testdir, "must-not-exist")
 # A file that is guaranteed to exist
 testfile = os.path.abspath(__file__)
+# A memory-backed directory for temporary files, if there is one
+shmdir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Constants used throughout, looked up once
+_LOG_ERR = xkb.lib.XKB_LOG_LEVEL_ERROR
+_LOG_DEBUG = xkb.lib.XKB_LOG_LEVEL_DEBUG
+_KEY_DOWN = xkb.XKB_KEY_DOWN
+_KEY_UP = xkb.XKB_KEY_UP
+_MODS_LOCKED = xkb.XKB_STATE_MODS_LOCKED
+_MATCH_ANY = xkb.XKB_STATE_MATCH_ANY
+_LAYOUT_EFFECTIVE = xkb.XKB_STATE_LAYOUT_EFFECTIVE
+
+# State components changed by pressing caps lock, and by applying the
+# resulting serialized state to a fresh state object
+_KEYDOWN_EXPECT = (xkb.XKB_STATE_LEDS | xkb.XKB_STATE_MODS_EFFECTIVE
+                   | xkb.XKB_STATE_MODS_LOCKED | xkb.XKB_STATE_MODS_DEPRESSED)
+_UPDATE_MASK_EXPECT = (xkb.XKB_STATE_LEDS | xkb.XKB_STATE_MODS_EFFECTIVE
+                       | xkb.XKB_STATE_MODS_LOCKED)
+
+# A context and keymap shared by every test that does not need to
+# alter them.  Compiling the sample keymap is by far the most
+# expensive thing these tests do, so we only do it once.
+_CTX = None
+_KM = None
+# A temporary file containing the sample keymap, written once.  Where
+# a memory-backed filesystem is available, it is used.
+_SAMPLE_KEYMAP_FILE = None
+
+
+def setUpModule():
+    global _CTX, _KM, _SAMPLE_KEYMAP_FILE
+    _CTX = xkb.Context()
+    _KM = _CTX.keymap_new_from_string(sample_keymap_string)
+    _SAMPLE_KEYMAP_FILE = tempfile.NamedTemporaryFile(mode='w+b', dir=shmdir)
+    _SAMPLE_KEYMAP_FILE.write(sample_keymap_bytes)
+    _SAMPLE_KEYMAP_FILE.flush()
+
+
+def tearDownModule():
+    global _CTX, _KM, _SAMPLE_KEYMAP_FILE
+    _SAMPLE_KEYMAP_FILE.close()
+    _CTX = _KM = _SAMPLE_KEYMAP_FILE = None
 
 
 class TestKeysym(TestCase):
     def test_keysym_get_name(self):
         self.assertEqual(xkb.keysym_get_name(0xff68), "Find")
 
+    def test_keysym_get_name_invalid(self):
+        with self.assertRaises(xkb.XKBInvalidKeysym):
+            xkb.keysym_get_name(0xffffffff)
+
+    def test_keysym_to_string_none(self):
+        self.assertIsNone(xkb.keysym_to_string(0))
+
     def test_keysym_from_name(self):
         self.assertEqual(xkb.keysym_from_name("space"), 0x20)
 
+    def test_keysym_from_name_case_insensitive(self):
+        self.assertEqual(xkb.keysym_from_name("SPACE"), 0)
+        self.assertEqual(
+            xkb.keysym_from_name("SPACE", case_insensitive=True), 0x20)
+
     def test_keysym_to_string(self):
         self.assertEqual(xkb.keysym_to_string(0x20), ' ')
 
@@ -40,17 +99,6 @@ class TestKeysym(TestCase):
 
 
 class TestContext(TestCase):
-    @classmethod
-    def setUpClass(cls):
-        # Create a temporary keymap file to use while testing.
-        cls._sample_keymap_file = tempfile.NamedTemporaryFile(
-            mode='w+b')
-        cls._sample_keymap_file.write(sample_keymap_bytes)
-
-    @classmethod
-    def tearDownClass(cls):
-        cls._sample_keymap_file.close()
-
     def test_create(self):
         xkb.Context()
 
@@ -75,6 +123,12 @@ class TestContext(TestCase):
             ctx.include_path_append(nonexistent)
         self.assertNotIn(nonexistent, ctx.include_path())
 
+    def test_include_path_updated_after_append(self):
+        ctx = xkb.Context(no_default_includes=True)
+        self.assertEqual(list(ctx.include_path()), [])
+        ctx.include_path_append(testdir)
+        self.assertEqual(list(ctx.include_path()), [testdir])
+
     def test_num_include_paths(self):
         ctx = xkb.Context()
         default_num_include_paths = ctx.num_include_paths()
@@ -84,9 +138,9 @@ class TestContext(TestCase):
 
     def test_set_log_level(self):
         ctx = xkb.Context()
-        self.assertEqual(ctx.get_log_level(), xkb.lib.XKB_LOG_LEVEL_ERROR)
-        ctx.set_log_level(xkb.lib.XKB_LOG_LEVEL_DEBUG)
-        self.assertEqual(ctx.get_log_level(), xkb.lib.XKB_LOG_LEVEL_DEBUG)
+        self.assertEqual(ctx.get_log_level(), _LOG_ERR)
+        ctx.set_log_level(_LOG_DEBUG)
+        self.assertEqual(ctx.get_log_level(), _LOG_DEBUG)
 
     def test_set_log_verbosity(self):
         ctx = xkb.Context()
@@ -101,12 +155,36 @@ class TestContext(TestCase):
             messages.append(message)
 
         ctx = xkb.Context()
-        ctx.set_log_level(xkb.lib.XKB_LOG_LEVEL_DEBUG)
+        ctx.set_log_level(_LOG_DEBUG)
         ctx.set_log_verbosity(10)
         ctx.set_log_fn(handler)
         ctx.keymap_new_from_string(sample_keymap_string)
         self.assertNotEqual(len(messages), 0)
 
+    def test_set_log_handler_long_message(self):
+        messages = []
+
+        def handler(context, level, message):
+            messages.append(message)
+
+        ctx = xkb.Context()
+        ctx.set_log_level(_LOG_DEBUG)
+        ctx.set_log_fn(handler)
+        longpath = os.path.join(nonexistent, "x" * 2000)
+        with self.assertRaises(xkb.XKBPathError):
+            ctx.include_path_append(longpath)
+        self.assertTrue(any(longpath in m for m in messages))
+
+    def test_thread_context(self):
+        ctx = xkb.thread_context()
+        self.assertIsInstance(ctx, xkb.Context)
+        self.assertIs(xkb.thread_context(), ctx)
+        other = []
+        t = threading.Thread(target=lambda: other.append(xkb.thread_context()))
+        t.start()
+        t.join()
+        self.assertIsNot(other[0], ctx)
+
     def test_keymap_new_from_names_with_args(self):
         # NB this test requires that suitable keymaps are installed
         # wherever xkbcommon expects to find them
@@ -121,10 +199,58 @@ class TestContext(TestCase):
         km = ctx.keymap_new_from_names()
         self.assertIsNotNone(km)
 
+    def test_keymap_new_from_names_cached(self):
+        # A cache hit shares the compiled keymap instead of compiling
+        # it again
+        ctx = xkb.Context()
+        km = ctx.keymap_new_from_names(layout="gb")
+        self.assertEqual(ctx.keymap_new_from_names(layout="gb")._keymap,
+                         km._keymap)
+        self.assertNotEqual(ctx.keymap_new_from_names(layout="us")._keymap,
+                            km._keymap)
+        ctx.include_path_append(testdir)
+        self.assertNotEqual(ctx.keymap_new_from_names(layout="gb")._keymap,
+                            km._keymap)
+
+    def test_keymap_new_from_names_uncached(self):
+        ctx = xkb.Context()
+        km = ctx.keymap_new_from_names(layout="gb")
+        self.assertNotEqual(
+            ctx.keymap_new_from_names(layout="gb", cache=False)._keymap,
+            km._keymap)
+        # Names taken from the environment are never cached
+        km = ctx.keymap_new_from_names()
+        self.assertNotEqual(ctx.keymap_new_from_names()._keymap, km._keymap)
+
+    def test_keymap_new_from_names_cache_lru(self):
+        ctx = xkb.Context()
+        km = ctx.keymap_new_from_names(layout="gb")
+        for i in range(xkb._KEYMAP_CACHE_SIZE):
+            # Using the keymap keeps it in the cache
+            ctx.keymap_new_from_names(layout="gb")
+            ctx.keymap_new_from_names(layout="us", options="opt%d" % i)
+        self.assertEqual(ctx.keymap_new_from_names(layout="gb")._keymap,
+                         km._keymap)
+
+    def test_keymap_new_from_names_cache_collectable(self):
+        # The cache must not create a reference cycle: a context and
+        # its cached keymaps are freed as soon as they are unused
+        gc.disable()
+        try:
+            ctx = xkb.Context()
+            km = ctx.keymap_new_from_names(layout="gb")
+            ctx_ref = weakref.ref(ctx)
+            km_ref = weakref.ref(km)
+            del km, ctx
+            self.assertIsNone(ctx_ref())
+            self.assertIsNone(km_ref())
+        finally:
+            gc.enable()
+
     def test_keymap_new_from_file_mmap(self):
         ctx = xkb.Context()
-        self._sample_keymap_file.seek(0)
-        km = ctx.keymap_new_from_file(self._sample_keymap_file)
+        _SAMPLE_KEYMAP_FILE.seek(0)
+        km = ctx.keymap_new_from_file(_SAMPLE_KEYMAP_FILE)
         self.assertIsNotNone(km, None)
         self.assertEqual(km.load_method, "mmap_file")
 
@@ -152,19 +278,29 @@ class TestContext(TestCase):
         km = ctx.keymap_new_from_buffer(test_data, length=length)
         self.assertIsNotNone(km)
 
+    def test_keymap_new_from_buffer_readonly(self):
+        ctx = xkb.Context()
+        km = ctx.keymap_new_from_buffer(sample_keymap_bytes)
+        self.assertIsNotNone(km)
+        self.assertEqual(km.load_method, "buffer")
+
 
 # This class makes use of the details of the sample keymap in
 # sample_keymap_string.
 class TestKeymap(TestCase):
     @classmethod
     def setUpClass(cls):
-        cls._ctx = xkb.Context()
-        cls.km = cls._ctx.keymap_new_from_string(sample_keymap_string)
+        cls.km = _KM
 
     def test_keymap_get_as_string(self):
         kms = self.km.get_as_string()
         self.assertNotEqual(len(kms), 0)
 
+    def test_keymap_get_as_bytes(self):
+        kms = self.km.get_as_bytes()
+        self.assertIsInstance(kms, bytes)
+        self.assertEqual(kms.decode('ascii'), self.km.get_as_string())
+
     def test_keymap_min_keycode(self):
         self.assertEqual(self.km.min_keycode(), 9)
 
@@ -174,6 +310,9 @@ class TestKeymap(TestCase):
     def test_keymap_iterate_over_keycodes(self):
         self.assertEqual(len(list(self.km)), 245)
 
+    def test_keymap_len(self):
+        self.assertEqual(len(self.km), 245)
+
     def test_keymap_key_names_roundtrip(self):
         # Test both key_get_name() and key_by_name()
         for keycode in iter(self.km):
@@ -199,6 +338,9 @@ class TestKeymap(TestCase):
     def test_keymap_mod_get_name(self):
         self.assertEqual(self.km.mod_get_name(0), "Shift")
 
+    def test_keymap_mod_get_name_interned(self):
+        self.assertIs(self.km.mod_get_name(0), self.km.mod_get_name(0))
+
     def test_keymap_mod_get_name_fail(self):
         with self.assertRaises(xkb.XKBInvalidModifierIndex):
             self.km.mod_get_name(self.km.num_mods())
@@ -210,6 +352,14 @@ class TestKeymap(TestCase):
         with self.assertRaises(xkb.XKBModifierDoesNotExist):
             self.km.mod_get_index("wibble")
 
+    def test_keymap_mod_get_index_repeated(self):
+        # Lookups are cached; failures must not be
+        self.assertEqual(self.km.mod_get_index("Lock"),
+                         self.km.mod_get_index("Lock"))
+        for _ in range(2):
+            with self.assertRaises(xkb.XKBModifierDoesNotExist):
+                self.km.mod_get_index("wibble")
+
     def test_keymap_num_layouts(self):
         self.assertEqual(self.km.num_layouts(), 2)
 
@@ -252,13 +402,29 @@ class TestKeymap(TestCase):
         key = next(iter(self.km))
         self.assertEqual(self.km.num_levels_for_key(key, 0), 1)
 
+    @skipUnless(hasattr(xkb.Keymap, "key_get_mods_for_level"),
+                "requires libxkbcommon >= 1.0")
+    def test_keymap_key_get_mods_for_level(self):
+        # Keycode 38 is 'a'; its second level is selected by Shift
+        shift = 1 << self.km.mod_get_index("Shift")
+        self.assertIn(shift, self.km.key_get_mods_for_level(38, 0, 1))
+
     def test_keymap_key_get_syms_by_level(self):
-        for key in self.km:
-            r = self.km.key_get_syms_by_level(key, 0, 0)
-            for k in r:
-                # If we are returned an invalid keysym, this will raise
-                # XKBInvalidKeysym
-                self.assertTrue(xkb.keysym_get_name(k))
+        # Keycode 65 is the space bar in our sample keymap
+        self.assertEqual(self.km.key_get_syms_by_level(65, 0, 0), [0x20])
+
+    def test_keymap_dump_syms(self):
+        syms = self.km.dump_syms()
+        self.assertIn((65, 0, 0, 0x20), syms)
+        # Keycode 38 is 'a', which has several shift levels
+        for level in range(self.km.num_levels_for_key(38, 0)):
+            self.assertEqual(
+                [s for k, la, le, s in syms
+                 if (k, la, le) == (38, 0, level)],
+                self.km.key_get_syms_by_level(38, 0, level))
+
+    def test_keymap_syms_by_level_are_valid(self):
+        self.assertTrue(self.km.syms_by_level_are_valid(0, 0))
 
     def test_keymap_key_repeats(self):
         key = next(iter(self.km))
@@ -294,6 +460,14 @@ class TestBitEnum(TestCase):
             ("StateMatch.XKB_STATE_MATCH_ALL|XKB_STATE_MATCH_ANY",
              "StateMatch.XKB_STATE_MATCH_ANY|XKB_STATE_MATCH_ALL"))
 
+    def test_state_component_unknown_bits(self):
+        # Components from a later libxkbcommon are kept, not rejected
+        known = sum(xkb.StateComponent)
+        self.assertIs(xkb._state_component(known), xkb._state_component(known))
+        c = xkb._state_component(known | 0x1000000)
+        self.assertIsInstance(c, xkb.StateComponent)
+        self.assertEqual(c, known | 0x1000000)
+
 
 class TestKeyboardState(TestCase):
     capslock = 66
@@ -301,11 +475,22 @@ class TestKeyboardState(TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls._ctx = xkb.Context()
-        cls.km = cls._ctx.keymap_new_from_string(sample_keymap_string)
+        cls.km = _KM
         cls.lock = cls.km.mod_get_index("Lock")
         cls.numlock = cls.km.mod_get_index("NumLock")
         cls.badmod = cls.km.num_mods()
+        # The serialized state after caps lock has been pressed and
+        # released, for tests that need caps lock to be on
+        state = cls.km.state_new()
+        state.update_key(cls.capslock, _KEY_DOWN)
+        state.update_key(cls.capslock, _KEY_UP)
+        cls.capslock_mask = (
+            state.serialize_mods(xkb.XKB_STATE_MODS_DEPRESSED),
+            state.serialize_mods(xkb.XKB_STATE_MODS_LATCHED),
+            state.serialize_mods(xkb.XKB_STATE_MODS_LOCKED),
+            state.serialize_layout(xkb.XKB_STATE_LAYOUT_DEPRESSED),
+            state.serialize_layout(xkb.XKB_STATE_LAYOUT_LATCHED),
+            state.serialize_layout(xkb.XKB_STATE_LAYOUT_LOCKED))
 
     def test_state_get_keymap(self):
         state = self.km.state_new()
@@ -315,26 +500,41 @@ class TestKeyboardState(TestCase):
     def test_state_update_key(self):
         state = self.km.state_new()
         self.assertEqual(
-            state.mod_name_is_active("Lock", xkb.XKB_STATE_MODS_LOCKED),
+            state.mod_name_is_active("Lock", _MODS_LOCKED),
             False)
-        keydown = state.update_key(self.capslock, xkb.XKB_KEY_DOWN)
-        self.assertEqual(
-            keydown, xkb.XKB_STATE_LEDS | xkb.XKB_STATE_MODS_EFFECTIVE
-            | xkb.XKB_STATE_MODS_LOCKED | xkb.XKB_STATE_MODS_DEPRESSED)
+        keydown = state.update_key(self.capslock, _KEY_DOWN)
+        self.assertEqual(keydown, _KEYDOWN_EXPECT)
         self.assertIsInstance(keydown, xkb.StateComponent)
         self.assertIsInstance(keydown, int)
-        keyup = state.update_key(self.capslock, xkb.XKB_KEY_UP)
+        keyup = state.update_key(self.capslock, _KEY_UP)
         self.assertEqual(
             keyup, xkb.XKB_STATE_MODS_DEPRESSED)
         self.assertEqual(
-            state.mod_name_is_active("Lock", xkb.XKB_STATE_MODS_LOCKED),
+            state.mod_name_is_active("Lock", _MODS_LOCKED),
             True)
 
+    def test_state_process_key(self):
+        state = self.km.state_new()
+        self.assertEqual(state.process_key(self.space, _KEY_DOWN),
+                         (0x20, 0x20, 0, 0))
+        keysym, utf32, consumed, changed = state.process_key(
+            self.capslock, _KEY_DOWN)
+        self.assertEqual((keysym, utf32), (65509, 0))
+        self.assertEqual(changed, _KEYDOWN_EXPECT)
+        self.assertIsInstance(changed, xkb.StateComponent)
+
+    def test_state_process_key_updates_active(self):
+        state = self.km.state_new()
+        self.assertFalse(state.mod_name_is_active("Lock", _MODS_LOCKED))
+        state.process_key(self.capslock, _KEY_DOWN)
+        state.process_key(self.capslock, _KEY_UP)
+        self.assertTrue(state.mod_name_is_active("Lock", _MODS_LOCKED))
+
     def test_state_update_mask(self):
         master_state = self.km.state_new()
         slave_state = self.km.state_new()
-        master_state.update_key(self.capslock, xkb.XKB_KEY_DOWN)
-        master_state.update_key(self.capslock, xkb.XKB_KEY_UP)
+        master_state.update_key(self.capslock, _KEY_DOWN)
+        master_state.update_key(self.capslock, _KEY_UP)
         depressed_mods = master_state.serialize_mods(
             xkb.XKB_STATE_MODS_DEPRESSED)
         latched_mods = master_state.serialize_mods(
@@ -348,20 +548,31 @@ class TestKeyboardState(TestCase):
         locked_layout = master_state.serialize_layout(
             xkb.XKB_STATE_LAYOUT_LOCKED)
         self.assertEqual(
-            slave_state.mod_name_is_active("Lock", xkb.XKB_STATE_MODS_LOCKED),
+            slave_state.mod_name_is_active("Lock", _MODS_LOCKED),
             False)
         r = slave_state.update_mask(
             depressed_mods, latched_mods, locked_mods,
             depressed_layout, latched_layout, locked_layout)
         self.assertIsInstance(r, int)
         self.assertIsInstance(r, xkb.StateComponent)
+        self.assertEqual(r, _UPDATE_MASK_EXPECT)
         self.assertEqual(
-            r, xkb.XKB_STATE_LEDS | xkb.XKB_STATE_MODS_EFFECTIVE
-            | xkb.XKB_STATE_MODS_LOCKED)
-        self.assertEqual(
-            slave_state.mod_name_is_active("Lock", xkb.XKB_STATE_MODS_LOCKED),
+            slave_state.mod_name_is_active("Lock", _MODS_LOCKED),
             True)
 
+    def test_state_serialize_mods_after_update(self):
+        state = self.km.state_new()
+        before = state.serialize_mods(_MODS_LOCKED)
+        state.update_mask(*self.capslock_mask)
+        self.assertNotEqual(state.serialize_mods(_MODS_LOCKED), before)
+
+    def test_state_serialize_layout_after_update(self):
+        state = self.km.state_new()
+        before = state.serialize_layout(_LAYOUT_EFFECTIVE)
+        # Lock the second layout
+        state.update_mask(0, 0, 0, 0, 0, 1)
+        self.assertNotEqual(state.serialize_layout(_LAYOUT_EFFECTIVE), before)
+
     def test_state_key_get_syms(self):
         state = self.km.state_new()
         syms = state.key_get_syms(self.space)
@@ -402,49 +613,60 @@ class TestKeyboardState(TestCase):
     def test_state_mod_names_are_active(self):
         state = self.km.state_new()
         self.assertFalse(
-            state.mod_names_are_active(xkb.XKB_STATE_MODS_LOCKED,
-                                       xkb.XKB_STATE_MATCH_ANY,
+            state.mod_names_are_active(_MODS_LOCKED,
+                                       _MATCH_ANY,
                                        ["Lock", "NumLock"]))
-        state.update_key(self.capslock, xkb.XKB_KEY_DOWN)
-        state.update_key(self.capslock, xkb.XKB_KEY_UP)
+        state.update_mask(*self.capslock_mask)
         self.assertTrue(
-            state.mod_names_are_active(xkb.XKB_STATE_MODS_LOCKED,
-                                       xkb.XKB_STATE_MATCH_ANY,
+            state.mod_names_are_active(_MODS_LOCKED,
+                                       _MATCH_ANY,
                                        ["Lock", "NumLock"]))
 
+    def test_state_mod_names_are_active_fail(self):
+        state = self.km.state_new()
+        with self.assertRaises(xkb.XKBModifierDoesNotExist):
+            state.mod_names_are_active(_MODS_LOCKED,
+                                       _MATCH_ANY,
+                                       ["Lock", "wibble"])
+
+    def test_state_active_mod_names(self):
+        state = self.km.state_new()
+        self.assertEqual(state.active_mod_names(_MODS_LOCKED), frozenset())
+        state.update_mask(*self.capslock_mask)
+        self.assertEqual(state.active_mod_names(_MODS_LOCKED),
+                         frozenset(["Lock"]))
+
     def test_state_mod_index_is_active(self):
         state = self.km.state_new()
         self.assertFalse(
-            state.mod_index_is_active(self.lock, xkb.XKB_STATE_MODS_LOCKED))
-        state.update_key(self.capslock, xkb.XKB_KEY_DOWN)
-        state.update_key(self.capslock, xkb.XKB_KEY_UP)
+            state.mod_index_is_active(self.lock, _MODS_LOCKED))
+        state.update_mask(*self.capslock_mask)
         self.assertTrue(
-            state.mod_index_is_active(self.lock, xkb.XKB_STATE_MODS_LOCKED))
+            state.mod_index_is_active(self.lock, _MODS_LOCKED))
 
     def test_state_mod_index_is_active_fail(self):
         state = self.km.state_new()
         with self.assertRaises(xkb.XKBInvalidModifierIndex):
             state.mod_index_is_active(self.badmod,
-                                      xkb.XKB_STATE_MODS_LOCKED)
+                                      _MODS_LOCKED)
 
     def test_state_mod_indices_are_active(self):
         state = self.km.state_new()
         self.assertFalse(
-            state.mod_indices_are_active(xkb.XKB_STATE_MODS_LOCKED,
-                                         xkb.XKB_STATE_MATCH_ANY,
+            state.mod_indices_are_active(_MODS_LOCKED,
+                                         _MATCH_ANY,
                                          [self.lock, self.numlock]))
-        state.update_key(self.capslock, xkb.XKB_KEY_DOWN)
-        state.update_key(self.capslock, xkb.XKB_KEY_UP)
+        state.update_mask(*self.capslock_mask)
         self.assertTrue(
-            state.mod_indices_are_active(xkb.XKB_STATE_MODS_LOCKED,
-                                         xkb.XKB_STATE_MATCH_ANY,
+            state.mod_indices_are_active(_MODS_LOCKED,
+                                         _MATCH_ANY,
                                          [self.lock, self.numlock]))
 
     def test_state_mod_indices_are_active_fail(self):
         state = self.km.state_new()
         with self.assertRaises(xkb.XKBInvalidModifierIndex):
-            state.mod_indices_are_active(xkb.XKB_STATE_MODS_LOCKED,
-                                         xkb.XKB_STATE_MATCH_ANY,
+            state.mod_indices_are_active(_MODS_LOCKED,
+                                         _MATCH_ANY,
                                          [self.badmod])
 
     def test_state_mod_index_is_consumed(self):
@@ -462,40 +684,89 @@ class TestKeyboardState(TestCase):
         state = self.km.state_new()
         self.assertEqual(
             state.mod_mask_remove_consumed(self.space, 0), 0)
+        # Locking the second layout changes what AE01 consumes
+        a = self.km.key_by_name("AE01")
+        for _ in range(2):
+            self.assertEqual(
+                state.mod_mask_remove_consumed(a, 0xff),
+                xkb.lib.xkb_state_mod_mask_remove_consumed(
+                    state._state, a, 0xff))
+            state.update_mask(0, 0, 0, 0, 0, 1)
+
+    def test_state_mod_mask_remove_consumed_out_of_range(self):
+        state = self.km.state_new()
+        with self.assertRaises(OverflowError):
+            state.mod_mask_remove_consumed(self.space, -1)
+        with self.assertRaises(OverflowError):
+            state.mod_mask_remove_consumed(self.space, 1 << 40)
 
     def test_state_key_get_consumed_mods(self):
         state = self.km.state_new()
         self.assertEqual(
             state.key_get_consumed_mods(self.space), 0)
 
+    def test_state_key_get_consumed_mods_after_update(self):
+        state = self.km.state_new()
+        # The 1 key has a third level in the first layout (English
+        # (UK)) but not in the second (English (US)), so locking the
+        # second layout changes which modifiers it consumes
+        ae01 = self.km.key_by_name("AE01")
+        before = state.key_get_consumed_mods(ae01)
+        state.update_mask(0, 0, 0, 0, 0, 1)
+        after = state.key_get_consumed_mods(ae01)
+        self.assertNotEqual(after, before)
+        self.assertEqual(after, xkb.lib.xkb_state_key_get_consumed_mods2(
+            state._state, ae01, xkb.XKB_CONSUMED_MODE_XKB))
+
     def test_state_layout_name_is_active(self):
         state = self.km.state_new()
         self.assertTrue(
             state.layout_name_is_active("English (UK)",
-                                        xkb.XKB_STATE_LAYOUT_EFFECTIVE))
+                                        _LAYOUT_EFFECTIVE))
+
+    def test_state_layout_name_is_active_after_update(self):
+        state = self.km.state_new()
+        self.assertFalse(
+            state.layout_name_is_active("English (US)", _LAYOUT_EFFECTIVE))
+        self.assertTrue(
+            state.layout_name_is_active("English (UK)", _LAYOUT_EFFECTIVE))
+        # Lock the second layout
+        state.update_mask(0, 0, 0, 0, 0, 1)
+        self.assertTrue(
+            state.layout_name_is_active("English (US)", _LAYOUT_EFFECTIVE))
+        self.assertFalse(
+            state.layout_name_is_active("English (UK)", _LAYOUT_EFFECTIVE))
 
     def test_state_layout_name_is_active_fail(self):
         state = self.km.state_new()
         with self.assertRaises(xkb.XKBLayoutDoesNotExist):
             state.layout_name_is_active("wibble",
-                                        xkb.XKB_STATE_LAYOUT_EFFECTIVE)
+                                        _LAYOUT_EFFECTIVE)
 
     def test_state_layout_index_is_active(self):
         state = self.km.state_new()
         self.assertTrue(
-            state.layout_index_is_active(0, xkb.XKB_STATE_LAYOUT_EFFECTIVE))
+            state.layout_index_is_active(0, _LAYOUT_EFFECTIVE))
+
+    def test_state_layout_index_is_active_after_update(self):
+        state = self.km.state_new()
+        self.assertFalse(state.layout_index_is_active(1, _LAYOUT_EFFECTIVE))
+        self.assertTrue(state.layout_index_is_active(0, _LAYOUT_EFFECTIVE))
+        # Lock the second layout
+        state.update_mask(0, 0, 0, 0, 0, 1)
+        self.assertTrue(state.layout_index_is_active(1, _LAYOUT_EFFECTIVE))
+        self.assertFalse(state.layout_index_is_active(0, _LAYOUT_EFFECTIVE))
 
     def test_state_layout_index_is_active_fail(self):
         state = self.km.state_new()
         with self.assertRaises(xkb.XKBInvalidLayoutIndex):
             state.layout_index_is_active(self.km.num_layouts(),
-                                         xkb.XKB_STATE_LAYOUT_EFFECTIVE)
+                                         _LAYOUT_EFFECTIVE)
 
     def test_state_led_name_is_active(self):
         state = self.km.state_new()
         self.assertFalse(state.led_name_is_active("Caps Lock"))
-        state.update_key(self.capslock, xkb.XKB_KEY_DOWN)
-        state.update_key(self.capslock, xkb.XKB_KEY_UP)
+        state.update_mask(*self.capslock_mask)
         self.assertTrue(state.led_name_is_active("Caps Lock"))
 
     def test_state_led_name_is_active_fail(self):
@@ -507,11 +778,26 @@ class TestKeyboardState(TestCase):
         state = self.km.state_new()
         capslockled = self.km.led_get_index("Caps Lock")
         self.assertFalse(state.led_index_is_active(capslockled))
-        state.update_key(self.capslock, xkb.XKB_KEY_DOWN)
-        state.update_key(self.capslock, xkb.XKB_KEY_UP)
+        state.update_mask(*self.capslock_mask)
         self.assertTrue(state.led_index_is_active(capslockled))
 
     def test_state_led_index_is_active_fail(self):
         state = self.km.state_new()
         with self.assertRaises(xkb.XKBInvalidLEDIndex):
             state.led_index_is_active(self.km.num_leds())
+
+
+class TestTeardown(TestCase):
+    def test_objects_alive_at_exit(self):
+        # Objects still referenced when the interpreter exits must be
+        # freed without error, whatever order the modules go away in
+        code = ("from tests.data import sample_keymap_string\n"
+                "from xkbcommon import xkb\n"
+                "ctx = xkb.Context()\n"
+                "km = ctx.keymap_new_from_string(sample_keymap_string)\n"
+                "state = km.state_new()\n")
+        r = subprocess.run([sys.executable, "-c", code],
+                           cwd=os.path.dirname(testdir),
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(r.stderr, b"")
@@ -1,10 +1,32 @@
+import subprocess
+import warnings
+
 from cffi import FFI
 ffibuilder = FFI()
 
+
+def _libxkbcommon_version():
+    """Return the (major, minor) version of libxkbcommon being built
+    against, according to pkg-config, or None if it can't be found.
+    """
+    try:
+        v = subprocess.check_output(
+            ["pkg-config", "--modversion", "xkbcommon"],
+            stderr=subprocess.DEVNULL)
+        return tuple(int(x) for x in v.decode("ascii").split(".")[:2])
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        warnings.warn(
+            "Could not find the libxkbcommon version with pkg-config; "
+            "functions added in libxkbcommon 1.0 will not be available")
+        return None
+
+
 # Currently implemented with reference to libxkbcommon-0.6.0
 
 ffibuilder.set_source("xkbcommon._ffi", """
 #include <stdarg.h>
+#include <stdio.h>
+#include <stdlib.h>
 #include <xkbcommon/xkbcommon.h>
 #include <xkbcommon/xkbcommon-keysyms.h>
 #include <xkbcommon/xkbcommon-compose.h>
@@ -19,13 +41,30 @@ static void _log_handler_internal(
     const char *format,
     va_list args)
 {
-  char buf[1024];
+  char stack_buf[512];
+  char *buf=stack_buf;
   void *user_data;
+  va_list args_copy;
+  int len;
+
+  /* Most messages fit on the stack; longer ones are formatted into
+   * a heap buffer of exactly the right size rather than truncated. */
+  va_copy(args_copy, args);
+  len=vsnprintf(NULL, 0, format, args_copy);
+  va_end(args_copy);
+  if (len < 0)
+    return;
+  if (len >= (int)sizeof(stack_buf)) {
+    buf=malloc(len + 1);
+    if (!buf)
+      return;
+  }
+  vsnprintf(buf, len + 1, format, args);
 
   user_data=xkb_context_get_user_data(context);
-  vsnprintf(buf, 1024, format, args);
-  buf[1023]=0;
   _log_handler(user_data, level, buf);
+  if (buf != stack_buf)
+    free(buf);
 }
 
 void _set_log_handler_internal(struct xkb_context *context)
@@ -33,11 +72,177 @@ void _set_log_handler_internal(struct xkb_context *context)
   xkb_context_set_log_fn(context, _log_handler_internal);
 }
 
+/* Keysym names and UTF-8 strings are returned in per-thread
+ * buffers, to save the caller allocating one for every call.  The
+ * result is only valid until the next call from the same thread. */
+static __thread char _keysym_buf[64];
+
+const char *_keysym_get_name(xkb_keysym_t keysym)
+{
+  int r;
+
+  r=xkb_keysym_get_name(keysym, _keysym_buf, sizeof(_keysym_buf));
+  if (r < 0 || r >= (int)sizeof(_keysym_buf))
+    return NULL;
+  return _keysym_buf;
+}
+
+const char *_keysym_to_utf8(xkb_keysym_t keysym)
+{
+  int r;
+
+  r=xkb_keysym_to_utf8(keysym, _keysym_buf, sizeof(_keysym_buf));
+  if (r <= 0)
+    return NULL;
+  return _keysym_buf;
+}
+
+/* Looks up a key in the current state and then updates the state
+ * for it.  out receives the keysym, the UTF-32 codepoint and the
+ * consumed modifiers, in that order. */
+enum xkb_state_component _state_process_key(struct xkb_state *state,
+                                            xkb_keycode_t key,
+                                            enum xkb_key_direction direction,
+                                            uint32_t *out)
+{
+  out[0]=xkb_state_key_get_one_sym(state, key);
+  out[1]=xkb_state_key_get_utf32(state, key);
+  out[2]=xkb_state_key_get_consumed_mods(state, key);
+  return xkb_state_update_key(state, key, direction);
+}
+
+/* Array form of xkb_state_mod_indices_are_active(), which is variadic.
+ * Matches the modifiers in the same way libxkbcommon does. */
+int _state_mod_indices_are_active(struct xkb_state *state,
+                                  enum xkb_state_component type,
+                                  enum xkb_state_match match,
+                                  const xkb_mod_index_t *mods,
+                                  size_t n)
+{
+  xkb_mod_index_t num_mods;
+  xkb_mod_mask_t wanted=0, active;
+  size_t i;
+
+  num_mods=xkb_keymap_num_mods(xkb_state_get_keymap(state));
+  for (i=0; i < n; i++) {
+    if (mods[i] >= num_mods)
+      return -1;
+    wanted |= (xkb_mod_mask_t) 1 << mods[i];
+  }
+
+  active=xkb_state_serialize_mods(state, type);
+  if (!(match & XKB_STATE_MATCH_NON_EXCLUSIVE) && (active & ~wanted))
+    return 0;
+  if (match & XKB_STATE_MATCH_ANY)
+    return (active & wanted) != 0;
+  return (active & wanted) == wanted;
+}
+
+/* Returns the LEDs that are active in the state as a mask, with bit
+ * n set for LED index n. */
+xkb_led_mask_t _state_led_mask(struct xkb_state *state)
+{
+  xkb_led_index_t i, num_leds;
+  xkb_led_mask_t mask=0;
+
+  num_leds=xkb_keymap_num_leds(xkb_state_get_keymap(state));
+  for (i=0; i < num_leds && i < 32; i++) {
+    if (xkb_state_led_index_is_active(state, i) == 1)
+      mask |= (xkb_led_mask_t) 1 << i;
+  }
+  return mask;
+}
+
+struct _keycode_collector {
+  xkb_keycode_t *out;
+  size_t n;
+  size_t cap;
+};
+
+static void _collect_keycode(struct xkb_keymap *keymap,
+                             xkb_keycode_t key,
+                             void *data)
+{
+  struct _keycode_collector *c=data;
+
+  if (c->n < c->cap)
+    c->out[c->n]=key;
+  c->n++;
+}
+
+/* Returns the number of keycodes in the keymap, of which at most
+ * cap are stored in out.  out may be NULL if cap is 0. */
+size_t _keymap_collect_keycodes(struct xkb_keymap *keymap,
+                                xkb_keycode_t *out,
+                                size_t cap)
+{
+  struct _keycode_collector c={out, 0, cap};
+
+  xkb_keymap_key_for_each(keymap, _collect_keycode, &c);
+  return c.n;
+}
+
+/* Stores (keycode, layout, level, keysym) for every keysym in the
+ * keymap in out, four values per entry, for at most cap entries.
+ * Returns the total number of entries. */
+size_t _keymap_dump_syms(struct xkb_keymap *keymap,
+                         uint32_t *out,
+                         size_t cap)
+{
+  const xkb_keysym_t *syms;
+  xkb_keycode_t key, max;
+  xkb_layout_index_t layout, num_layouts;
+  xkb_level_index_t level, num_levels;
+  size_t n=0;
+  int i, num_syms;
+
+  max=xkb_keymap_max_keycode(keymap);
+  for (key=xkb_keymap_min_keycode(keymap); key <= max; key++) {
+    num_layouts=xkb_keymap_num_layouts_for_key(keymap, key);
+    for (layout=0; layout < num_layouts; layout++) {
+      num_levels=xkb_keymap_num_levels_for_key(keymap, key, layout);
+      for (level=0; level < num_levels; level++) {
+        num_syms=xkb_keymap_key_get_syms_by_level(
+          keymap, key, layout, level, &syms);
+        for (i=0; i < num_syms; i++) {
+          if (n < cap) {
+            out[4 * n]=key;
+            out[4 * n + 1]=layout;
+            out[4 * n + 2]=level;
+            out[4 * n + 3]=syms[i];
+          }
+          n++;
+        }
+      }
+    }
+  }
+  return n;
+}
+
+int _keymap_syms_by_level_valid(struct xkb_keymap *keymap,
+                                xkb_layout_index_t layout,
+                                xkb_level_index_t level)
+{
+  const xkb_keysym_t *syms;
+  xkb_keycode_t key, max;
+  char name[64];
+  int i, n;
+
+  max=xkb_keymap_max_keycode(keymap);
+  for (key=xkb_keymap_min_keycode(keymap); key <= max; key++) {
+    n=xkb_keymap_key_get_syms_by_level(keymap, key, layout, level, &syms);
+    for (i=0; i < n; i++) {
+      if (xkb_keysym_get_name(syms[i], name, sizeof(name)) < 0)
+        return 0;
+    }
+  }
+  return 1;
+}
+
 """,
                       libraries=['xkbcommon'])
 
 ffibuilder.cdef("""
-typedef ... FILE;
 typedef ... va_list;
 
 struct xkb_context;
@@ -172,11 +377,6 @@ enum xkb_keymap_format {
     XKB_KEYMAP_FORMAT_TEXT_V1 = ...
 };
 
-struct xkb_keymap *
-xkb_keymap_new_from_file(struct xkb_context *context, FILE *file,
-                         enum xkb_keymap_format format,
-                         enum xkb_keymap_compile_flags flags);
-
 struct xkb_keymap *
 xkb_keymap_new_from_string(struct xkb_context *context, const char *string,
                            enum xkb_keymap_format format,
@@ -414,13 +614,6 @@ xkb_compose_table_new_from_locale(struct xkb_context *context,
                                   const char *locale,
                                   enum xkb_compose_compile_flags flags);
 
-struct xkb_compose_table *
-xkb_compose_table_new_from_file(struct xkb_context *context,
-                                FILE *file,
-                                const char *locale,
-                                enum xkb_compose_format format,
-                                enum xkb_compose_compile_flags flags);
-
 struct xkb_compose_table *
 xkb_compose_table_new_from_buffer(struct xkb_context *context,
                                   const char *buffer, size_t length,
@@ -482,18 +675,54 @@ xkb_compose_state_get_one_sym(struct xkb_compose_state *state);
 
 void _set_log_handler_internal(struct xkb_context *context);
 
+const char *_keysym_get_name(xkb_keysym_t keysym);
+
+const char *_keysym_to_utf8(xkb_keysym_t keysym);
+
+enum xkb_state_component _state_process_key(struct xkb_state *state,
+                                            xkb_keycode_t key,
+                                            enum xkb_key_direction direction,
+                                            uint32_t *out);
+
+int _state_mod_indices_are_active(struct xkb_state *state,
+                                  enum xkb_state_component type,
+                                  enum xkb_state_match match,
+                                  const xkb_mod_index_t *mods,
+                                  size_t n);
+
+xkb_led_mask_t _state_led_mask(struct xkb_state *state);
+
+size_t _keymap_collect_keycodes(struct xkb_keymap *keymap,
+                                xkb_keycode_t *out,
+                                size_t cap);
+
+size_t _keymap_dump_syms(struct xkb_keymap *keymap,
+                         uint32_t *out,
+                         size_t cap);
+
+int _keymap_syms_by_level_valid(struct xkb_keymap *keymap,
+                                xkb_layout_index_t layout,
+                                xkb_level_index_t level);
+
 extern "Python" void _log_handler(void *user_data,
                                   enum xkb_log_level level,
                                   const char *message);
 
-extern "Python" void _key_for_each_helper(
-    struct xkb_keymap *keymap,
-    xkb_keycode_t key,
-    void *data);
-
 void free(void *ptr);
 
 """)
 
-if __name__ == "__main__":
-    ffibuilder.compile(verbose=True)
+# Functions added after the release referenced above are only declared
+# when building against a library that provides them, so that the
+# package still builds against older releases.  Check for them with
+# hasattr(lib, ...).
+if (_libxkbcommon_version() or (0, 0)) >= (1, 0):
+    ffibuilder.cdef("""
+size_t
+xkb_keymap_key_get_mods_for_level(struct xkb_keymap *keymap,
+                                  xkb_keycode_t key,
+                                  xkb_layout_index_t layout,
+                                  xkb_level_index_t level,
+                                  xkb_mod_mask_t *masks_out,
+                                  size_t masks_size);
+""")
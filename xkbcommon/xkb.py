@@ -1,20 +1,13 @@
+import array
 import enum
+import functools
 import mmap
 import sys
+import threading
 
 from xkbcommon._ffi import ffi, lib
 
 
-class _keepref:
-    """Function wrapper that keeps a reference to another object."""
-    def __init__(self, ref, func):
-        self.ref = ref
-        self.func = func
-
-    def __call__(self, *args, **kwargs):
-        self.func(*args, **kwargs)
-
-
 # enum.IntFlag was changed in a non-backward-compatible manner in
 # Python 3.11: the __str__ method was changed to int.__str__(). We
 # retain the old behaviour because it is useful, and in order not to
@@ -122,42 +115,47 @@ def _log_handler(user_data, level, message):
         context._log_fn(context, level, ffi.string(message).decode('utf8'))
 
 
-# Internal helper for keycode iteration
-@ffi.def_extern(onerror=_onerror_do_nothing)
-def _key_for_each_helper(keymap, key, data):
-    k = ffi.from_handle(data)
-    k.append(key)
-
-
 # Keysyms http://xkbcommon.org/doc/current/group__keysyms.html
 
-def keysym_get_name(keysym):
-    "Get the name of a keysym."
-    name = ffi.new("char[64]")
-    r = lib.xkb_keysym_get_name(keysym, name, len(name))
-    if r == -1:
+# Keysym names and strings never change, and clients tend to look up
+# the same few over and over, so the lookups are cached.
+
+@functools.lru_cache(maxsize=1024)
+def _keysym_get_name_cached(keysym):
+    r = lib._keysym_get_name(keysym)
+    if r == ffi.NULL:
         raise XKBInvalidKeysym()
-    if r > len(name):
-        raise XKBBufferTooSmall()
-    return ffi.string(name).decode('ascii')
+    return sys.intern(ffi.string(r).decode('ascii'))
 
 
-def keysym_from_name(name, case_insensitive=False):
-    "Get a keysym from its name."
+@functools.lru_cache(maxsize=1024)
+def _keysym_from_name_cached(name, case_insensitive):
     flags = 0
     if case_insensitive:
         flags = flags | lib.XKB_KEYSYM_CASE_INSENSITIVE
     return lib.xkb_keysym_from_name(name.encode('ascii'), flags)
 
 
-def keysym_to_string(keysym):
-    buffer = ffi.new("char[64]")
-    r = lib.xkb_keysym_to_utf8(keysym, buffer, len(buffer))
-    if r == -1:
-        raise XKBBufferTooSmall()
-    if r == 0:
+@functools.lru_cache(maxsize=1024)
+def _keysym_to_string_cached(keysym):
+    r = lib._keysym_to_utf8(keysym)
+    if r == ffi.NULL:
         return
-    return ffi.string(buffer).decode('utf8')
+    return ffi.string(r).decode('utf8')
+
+
+def keysym_get_name(keysym):
+    "Get the name of a keysym."
+    return _keysym_get_name_cached(keysym)
+
+
+def keysym_from_name(name, case_insensitive=False):
+    "Get a keysym from its name."
+    return _keysym_from_name_cached(name, bool(case_insensitive))
+
+
+def keysym_to_string(keysym):
+    return _keysym_to_string_cached(keysym)
 
 
 def keysym_to_upper(keysym):
@@ -182,6 +180,11 @@ def keysym_to_lower(keysym):
 
 # Library Context http://xkbcommon.org/doc/current/group__context.html
 
+# The number of keymaps compiled from RMLVO names that each Context
+# keeps around for reuse
+_KEYMAP_CACHE_SIZE = 16
+
+
 class Context:
     """xkbcommon library context.
 
@@ -201,6 +204,9 @@ class Context:
     XKB_DEFAULT_OPTIONS - see xkb_rule_names.
     """
 
+    __slots__ = ('_context', '_log_fn', '_keymap_cache', '_include_paths',
+                 '_userdata', '__weakref__')
+
     def __init__(self, no_default_includes=False, no_environment_names=False):
         """Create a new context.
 
@@ -220,11 +226,13 @@ class Context:
         context = lib.xkb_context_new(flags)
         if not context:
             raise XKBError("Couldn't create XKB context")
-        self._context = ffi.gc(context, _keepref(lib, lib.xkb_context_unref))
+        self._context = ffi.gc(context, lib.xkb_context_unref)
         self._log_fn = None
-        # We keep a reference to the handle to keep it alive
-        self._userdata = ffi.new_handle(self)
-        lib.xkb_context_set_user_data(self._context, self._userdata)
+        self._keymap_cache = {}
+        self._include_paths = None
+        # The handle passed to the log callback is only created when
+        # a log function is set; see set_log_fn()
+        self._userdata = None
 
     # Include Paths http://xkbcommon.org/doc/current/group__include-path.html
 
@@ -232,12 +240,16 @@ class Context:
         "Append a new entry to the context's include path."
         r = lib.xkb_context_include_path_append(
             self._context, path.encode('utf8'))
+        self._keymap_cache.clear()
+        self._include_paths = None
         if r != 1:
             raise XKBPathError("Failed to append to include path")
 
     def include_path_append_default(self):
         "Append the default include paths to the context's include path."
         r = lib.xkb_context_include_path_append_default(self._context)
+        self._keymap_cache.clear()
+        self._include_paths = None
         if r != 1:
             raise XKBPathError("Failed to append default include paths")
 
@@ -248,6 +260,8 @@ class Context:
         inserts the default paths.
         """
         r = lib.xkb_context_include_path_reset_defaults(self._context)
+        self._keymap_cache.clear()
+        self._include_paths = None
         if r != 1:
             raise XKBPathError("Failed to restore default include path")
 
@@ -268,13 +282,11 @@ class Context:
 
     def include_path(self):
         "Iterate over the include path."
-        i = 0
-        while True:
-            p = self.include_path_get(i)
-            if not p:
-                return
-            yield p
-            i += 1
+        if self._include_paths is None:
+            self._include_paths = tuple(
+                self.include_path_get(i)
+                for i in range(self.num_include_paths()))
+        return iter(self._include_paths)
 
     # Logging Handling http://xkbcommon.org/doc/current/group__logging.html
 
@@ -337,6 +349,10 @@ class Context:
         to install a custom function to handle logging messages.
         """
         if handler:
+            if self._userdata is None:
+                # We keep a reference to the handle to keep it alive
+                self._userdata = ffi.new_handle(self)
+                lib.xkb_context_set_user_data(self._context, self._userdata)
             lib._set_log_handler_internal(self._context)
             self._log_fn = handler
         else:
@@ -345,7 +361,7 @@ class Context:
     # Keymap Creation http://xkbcommon.org/doc/current/group__keymap.html
 
     def keymap_new_from_names(self, rules=None, model=None, layout=None,
-                              variant=None, options=None):
+                              variant=None, options=None, cache=True):
         """Create a keymap from RMLVO names.
 
         The primary keymap entry point: creates a new XKB keymap from
@@ -354,7 +370,33 @@ class Context:
 
         Returns a Keymap compiled according to the RMLVO names, or
         None if the compilation failed.
+
+        Keymaps are immutable, so the most recently used compiled
+        keymaps are remembered, and when the same names are passed
+        again a new Keymap sharing the already compiled keymap is
+        returned without compiling it again.  Because nothing is
+        compiled in that case, no log messages are produced for it.
+        The cache is emptied whenever the include path is changed; it
+        does not notice changes to the XKB_DEFAULT_* environment
+        variables or to files on disk.  Pass cache=False to always
+        compile a fresh keymap, for example to pick up edited files.
+        Keymaps compiled with every name left as None depend on the
+        environment, and are never cached.
         """
+        cache_key = (rules, model, layout, variant, options)
+        if not cache or not any(cache_key):
+            cache_key = None
+        # The cache holds the compiled keymaps rather than Keymap
+        # objects: a Keymap refers back to its Context, and would
+        # keep the Context alive in a reference cycle.
+        keymap_cache = self._keymap_cache
+        if cache_key is not None:
+            try:
+                r = keymap_cache[cache_key] = keymap_cache.pop(cache_key)
+            except KeyError:
+                pass
+            else:
+                return Keymap(self, lib.xkb_keymap_ref(r), "names")
         # CFFI memory management note:
         # The C strings allocated below using ffi.new("char[]", ...)
         # are automatically deallocated when there are no remaining
@@ -365,10 +407,12 @@ class Context:
         # use-after-free.
         names = ffi.new("struct xkb_rule_names *")
         keep_alive = []
-        for x in ("rules", "model", "layout", "variant", "options"):
-            if locals()[x]:
-                c = ffi.new("char[]", locals()[x].encode())
-                setattr(names, x, c)
+        for attr, val in (("rules", rules), ("model", model),
+                          ("layout", layout), ("variant", variant),
+                          ("options", options)):
+            if val:
+                c = ffi.new("char[]", val.encode())
+                setattr(names, attr, c)
                 keep_alive.append(c)
         r = lib.xkb_keymap_new_from_names(
             self._context, names, lib.XKB_KEYMAP_COMPILE_NO_FLAGS)
@@ -376,7 +420,14 @@ class Context:
         if r == ffi.NULL:
             raise XKBKeymapCreationFailure(
                 "xkb_keymap_new_from_names returned NULL")
-        return Keymap(self, r, "names")
+        if cache_key is None:
+            return Keymap(self, r, "names")
+        if len(keymap_cache) >= _KEYMAP_CACHE_SIZE:
+            # Dicts preserve insertion order, and hits are moved to
+            # the end: drop the least recently used entry
+            del keymap_cache[next(iter(keymap_cache))]
+        keymap_cache[cache_key] = ffi.gc(r, lib.xkb_keymap_unref)
+        return Keymap(self, lib.xkb_keymap_ref(r), "names")
 
     # We can't call xkb_keymap_new_from_file directly because we have
     # no way to get a C stdio FILE * for a file opened by python.  We
@@ -396,9 +447,14 @@ class Context:
         else:
             load_method = "mmap_file"
             mm = mmap.mmap(fn, 0)
+            # libxkbcommon reads the file once from start to end
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            if hasattr(mmap, "MADV_WILLNEED"):
+                mm.madvise(mmap.MADV_WILLNEED)
             buf = ffi.from_buffer(mm)
             r = lib.xkb_keymap_new_from_buffer(
-                self._context, buf, mm.size(), format,
+                self._context, buf, len(mm), format,
                 lib.XKB_KEYMAP_COMPILE_NO_FLAGS)
             del buf
             mm.close()
@@ -422,7 +478,13 @@ class Context:
 
     def keymap_new_from_buffer(
             self, buffer, format=lib.XKB_KEYMAP_FORMAT_TEXT_V1, length=None):
-        "Create a Keymap from a memory buffer."
+        """Create a Keymap from a memory buffer.
+
+        buffer may be any object supporting the buffer protocol,
+        including bytes (which needs cffi 1.8 or later); it is passed
+        to libxkbcommon without being copied.  libxkbcommon does not
+        keep a reference to it once the keymap is compiled.
+        """
         buf = ffi.from_buffer(buffer)
         r = lib.xkb_keymap_new_from_buffer(
             self._context, buf, length if length else len(buf), format,
@@ -433,6 +495,25 @@ class Context:
         return Keymap(self, r, "buffer")
 
 
+_thread_local = threading.local()
+
+
+def thread_context():
+    """Get a Context belonging to the calling thread.
+
+    libxkbcommon contexts must not be used from more than one thread
+    at a time.  This returns a default Context which is created the
+    first time it is asked for in each thread and reused afterwards,
+    so that threads which compile keymaps in parallel each have their
+    own context and log handler without having to keep track of it.
+    """
+    try:
+        return _thread_local.context
+    except AttributeError:
+        context = _thread_local.context = Context()
+        return context
+
+
 class Keymap:
     """A keymap.
 
@@ -440,13 +521,39 @@ class Keymap:
     'keymap_new_from_' methods of Context.
     """
 
+    __slots__ = ('load_method', '_context', '_keymap', '_valid_keycodes',
+                 '_min_keycode', '_max_keycode', '_num_mods', '_num_layouts',
+                 '_num_leds', '_num_keycodes', '_key_by_name_cache',
+                 '_mod_name_cache', '_layout_name_cache', '_led_name_cache',
+                 '_mod_index_cache', '_layout_index_cache', '_led_index_cache',
+                 '_as_bytes_cache', '__weakref__')
+
     def __init__(self, context, pointer, load_method):
         self.load_method = load_method
         self._context = context
 
-        self._keymap = ffi.gc(pointer, _keepref(lib, lib.xkb_keymap_unref))
+        self._keymap = ffi.gc(pointer, lib.xkb_keymap_unref)
         self._valid_keycodes = None
 
+        # These never change for a compiled keymap
+        self._min_keycode = lib.xkb_keymap_min_keycode(pointer)
+        self._max_keycode = lib.xkb_keymap_max_keycode(pointer)
+        self._num_mods = lib.xkb_keymap_num_mods(pointer)
+        self._num_layouts = lib.xkb_keymap_num_layouts(pointer)
+        self._num_leds = lib.xkb_keymap_num_leds(pointer)
+        self._num_keycodes = lib._keymap_collect_keycodes(pointer, ffi.NULL, 0)
+
+        # A keymap is immutable once compiled, so name to index
+        # lookups can be cached for the lifetime of the object.
+        self._key_by_name_cache = {}
+        self._mod_name_cache = {}
+        self._layout_name_cache = {}
+        self._led_name_cache = {}
+        self._mod_index_cache = {}
+        self._layout_index_cache = {}
+        self._led_index_cache = {}
+        self._as_bytes_cache = {}
+
     def get_as_bytes(self, format=lib.XKB_KEYMAP_FORMAT_TEXT_V1):
         """Get the compiled keymap as bytes.
 
@@ -454,11 +561,16 @@ class Keymap:
 
         On Python 2 will return a str object.
         """
+        try:
+            return self._as_bytes_cache[format]
+        except KeyError:
+            pass
         r = lib.xkb_keymap_get_as_string(self._keymap, format)
         if r == ffi.NULL:
             raise XKBKeymapReadError()
         kms = ffi.string(r)
         lib.free(r)
+        self._as_bytes_cache[format] = kms
         return kms
 
     def get_as_string(self, format=lib.XKB_KEYMAP_FORMAT_TEXT_V1):
@@ -468,31 +580,37 @@ class Keymap:
 
         On Python 2 will return a unicode object.
         """
+        # Only the bytes are cached, so the keymap text isn't kept
+        # around twice
         return self.get_as_bytes(format).decode('ascii')
 
     # Keymap Components http://xkbcommon.org/doc/current/group__components.html
 
     def min_keycode(self):
         "Get the minimum keycode in the keymap."
-        return lib.xkb_keymap_min_keycode(self._keymap)
+        return self._min_keycode
 
     def max_keycode(self):
         "Get the maximum keycode in the keymap."
-        return lib.xkb_keymap_max_keycode(self._keymap)
+        return self._max_keycode
 
     # The xkb_keymap_key_for_each() call isn't very amenable to being
     # used directly from python.  It's much more useful to implement a
     # python iterable instead.
     def _get_valid_keycodes(self):
-        """Fetch a list of valid keycodes in the keymap.
+        """Fetch an array of valid keycodes in the keymap.
 
-        Uses the xkb_keymap_key_for_each() call.
+        Uses the xkb_keymap_key_for_each() call from C to fill an
+        array, so the whole keymap is walked in a single call.
         """
-        keycodes = []
-        keycode_ref = ffi.new_handle(keycodes)
-        lib.xkb_keymap_key_for_each(
-            self._keymap, lib._key_for_each_helper, keycode_ref)
-        self._valid_keycodes = keycodes
+        size = self._max_keycode - self._min_keycode + 1
+        keycodes = ffi.new("xkb_keycode_t[]", size)
+        n = lib._keymap_collect_keycodes(self._keymap, keycodes, size)
+        if n > size:
+            raise XKBBufferTooSmall()
+        valid = array.array('I')
+        valid.frombytes(ffi.buffer(keycodes, n * ffi.sizeof("xkb_keycode_t")))
+        self._valid_keycodes = valid
 
     def __iter__(self):
         """Iterate over valid keycodes"""
@@ -500,6 +618,10 @@ class Keymap:
             self._get_valid_keycodes()
         return iter(self._valid_keycodes)
 
+    def __len__(self):
+        """Return the number of valid keycodes"""
+        return self._num_keycodes
+
     def key_get_name(self, key):
         r = lib.xkb_keymap_key_get_name(self._keymap, key)
         if r == ffi.NULL:
@@ -507,14 +629,19 @@ class Keymap:
         return ffi.string(r).decode('ascii')
 
     def key_by_name(self, name):
+        try:
+            return self._key_by_name_cache[name]
+        except KeyError:
+            pass
         r = lib.xkb_keymap_key_by_name(self._keymap, name.encode('ascii'))
         if r == lib.XKB_KEYCODE_INVALID:
             raise XKBKeyDoesNotExist(name)
+        self._key_by_name_cache[name] = r
         return r
 
     def num_mods(self):
         """Get the number of modifiers in the keymap."""
-        return lib.xkb_keymap_num_mods(self._keymap)
+        return self._num_mods
 
     def mod_get_name(self, idx):
         """Get the name of a modifier by index.
@@ -522,10 +649,16 @@ class Keymap:
         Returns the name.  If the index is invalid, raises
         XKBInvalidModifierIndex.
         """
+        try:
+            return self._mod_name_cache[idx]
+        except KeyError:
+            pass
         r = lib.xkb_keymap_mod_get_name(self._keymap, idx)
         if r == ffi.NULL:
             raise XKBInvalidModifierIndex()
-        return ffi.string(r).decode('ascii')
+        name = sys.intern(ffi.string(r).decode('ascii'))
+        self._mod_name_cache[idx] = name
+        return name
 
     def mod_get_index(self, name):
         """Get the index of a modifier by name.
@@ -533,14 +666,19 @@ class Keymap:
         Returns the index.  If no modifier with this name exists,
         raises XKBModifierDoesNotExist.
         """
+        try:
+            return self._mod_index_cache[name]
+        except KeyError:
+            pass
         r = lib.xkb_keymap_mod_get_index(self._keymap, name.encode('ascii'))
         if r == lib.XKB_MOD_INVALID:
             raise XKBModifierDoesNotExist(name)
+        self._mod_index_cache[name] = r
         return r
 
     def num_layouts(self):
         """Get the number of layouts in the keymap."""
-        return lib.xkb_keymap_num_layouts(self._keymap)
+        return self._num_layouts
 
     def layout_get_name(self, idx):
         """Get the name of a layout by index.
@@ -548,12 +686,18 @@ class Keymap:
         Returns the name.  If the layout does not have a name, returns
         None.  If the index is invalid, raises XKBInvalidLayoutIndex.
         """
-        if idx >= self.num_layouts():
+        try:
+            return self._layout_name_cache[idx]
+        except KeyError:
+            pass
+        if idx >= self._num_layouts:
             raise XKBInvalidLayoutIndex()
         r = lib.xkb_keymap_layout_get_name(self._keymap, idx)
-        if r == ffi.NULL:
-            return
-        return ffi.string(r).decode('ascii')
+        name = None
+        if r != ffi.NULL:
+            name = sys.intern(ffi.string(r).decode('ascii'))
+        self._layout_name_cache[idx] = name
+        return name
 
     def layout_get_index(self, name):
         """Get the index of a layout by name.
@@ -562,9 +706,14 @@ class Keymap:
         XKBLayoutDoesNotExist. If more than one layout in the keymap
         has this name, returns the lowest index among them.
         """
+        try:
+            return self._layout_index_cache[name]
+        except KeyError:
+            pass
         r = lib.xkb_keymap_layout_get_index(self._keymap, name.encode('ascii'))
         if r == lib.XKB_LAYOUT_INVALID:
             raise XKBLayoutDoesNotExist(name)
+        self._layout_index_cache[name] = r
         return r
 
     def num_leds(self):
@@ -576,17 +725,23 @@ class Keymap:
         case when calling functions such as Keymap.led_get_name()
         or State.led_index_is_active().
         """
-        return lib.xkb_keymap_num_leds(self._keymap)
+        return self._num_leds
 
     def led_get_name(self, idx):
         """Get the name of a LED by index.
 
         Returns the name. If the index is invalid, returns None.
         """
+        try:
+            return self._led_name_cache[idx]
+        except KeyError:
+            pass
         r = lib.xkb_keymap_led_get_name(self._keymap, idx)
         if r == ffi.NULL:
             raise XKBInvalidLEDIndex()
-        return ffi.string(r).decode('ascii')
+        name = sys.intern(ffi.string(r).decode('ascii'))
+        self._led_name_cache[idx] = name
+        return name
 
     def led_get_index(self, name):
         """Get the index of a LED by name.
@@ -594,9 +749,14 @@ class Keymap:
         Returns the index. If no LED with this name exists, returns
         lib.XKB_LED_INVALID.
         """
+        try:
+            return self._led_index_cache[name]
+        except KeyError:
+            pass
         r = lib.xkb_keymap_led_get_index(self._keymap, name.encode('ascii'))
         if r == lib.XKB_LED_INVALID:
             raise XKBLEDDoesNotExist(name)
+        self._led_index_cache[name] = r
         return r
 
     def num_layouts_for_key(self, key):
@@ -618,6 +778,28 @@ class Keymap:
         """
         return lib.xkb_keymap_num_levels_for_key(self._keymap, key, layout)
 
+    if hasattr(lib, "xkb_keymap_key_get_mods_for_level"):
+        def key_get_mods_for_level(self, key, layout, level):
+            """Get the modifier masks which select a shift level for a key.
+
+            The level is selected in the given layout when exactly the
+            modifiers in one of the masks are active, after any
+            modifiers which are not significant for the key's type
+            have been removed.
+
+            Returns a list of modifier masks, which is empty if the
+            key, layout or level is invalid.  Only available when
+            built against libxkbcommon 1.0 or later.
+            """
+            size = 16
+            while True:
+                masks = ffi.new("xkb_mod_mask_t[]", size)
+                r = lib.xkb_keymap_key_get_mods_for_level(
+                    self._keymap, key, layout, level, masks, size)
+                if r < size:
+                    return list(masks[0:r])
+                size *= 2
+
     def key_get_syms_by_level(self, key, layout, level):
         """Get the keysyms obtained from pressing a key in a given layout and
         shift level.
@@ -631,12 +813,36 @@ class Keymap:
         syms_out = ffi.new("const xkb_keysym_t **")
         r = lib.xkb_keymap_key_get_syms_by_level(
             self._keymap, key, layout, level, syms_out)
-        syms = []
-        if r > 0:
-            assert syms_out[0] != ffi.NULL
-        for i in range(0, r):
-            syms.append(syms_out[0][i])
-        return syms
+        if r <= 0:
+            return []
+        return list(syms_out[0][0:r])
+
+    def dump_syms(self):
+        """Get every keysym in the keymap.
+
+        This is equivalent to calling Keymap.key_get_syms_by_level()
+        for every layout and shift level of every key, but the
+        iteration takes place entirely in C.
+
+        Returns a list of (keycode, layout, level, keysym) tuples.
+        """
+        n = lib._keymap_dump_syms(self._keymap, ffi.NULL, 0)
+        buf = ffi.new("uint32_t[]", 4 * n)
+        lib._keymap_dump_syms(self._keymap, buf, n)
+        values = iter(buf[0:4 * n])
+        return list(zip(values, values, values, values))
+
+    def syms_by_level_are_valid(self, layout, level):
+        """Check the keysyms of every key in a given layout and shift level.
+
+        This is equivalent to calling Keymap.key_get_syms_by_level()
+        for each keycode and keysym_get_name() for each keysym
+        returned, but the iteration takes place entirely in C.
+
+        Returns True if every keysym has a name, False otherwise.
+        """
+        return lib._keymap_syms_by_level_valid(
+            self._keymap, layout, level) == 1
 
     def key_repeats(self, key):
         """Determine whether a key should repeat or not.
@@ -724,19 +930,73 @@ class ConsumedMode(enum.IntEnum):
 
 
 # Global names for enum members
-for _ec in (KeyDirection, StateComponent, StateMatch, ConsumedMode):
-    for _sc in _ec:
-        globals()[_sc.name] = _sc
+XKB_KEY_UP = KeyDirection.XKB_KEY_UP
+XKB_KEY_DOWN = KeyDirection.XKB_KEY_DOWN
+XKB_STATE_MODS_DEPRESSED = StateComponent.XKB_STATE_MODS_DEPRESSED
+XKB_STATE_MODS_LATCHED = StateComponent.XKB_STATE_MODS_LATCHED
+XKB_STATE_MODS_LOCKED = StateComponent.XKB_STATE_MODS_LOCKED
+XKB_STATE_MODS_EFFECTIVE = StateComponent.XKB_STATE_MODS_EFFECTIVE
+XKB_STATE_LAYOUT_DEPRESSED = StateComponent.XKB_STATE_LAYOUT_DEPRESSED
+XKB_STATE_LAYOUT_LATCHED = StateComponent.XKB_STATE_LAYOUT_LATCHED
+XKB_STATE_LAYOUT_LOCKED = StateComponent.XKB_STATE_LAYOUT_LOCKED
+XKB_STATE_LAYOUT_EFFECTIVE = StateComponent.XKB_STATE_LAYOUT_EFFECTIVE
+XKB_STATE_LEDS = StateComponent.XKB_STATE_LEDS
+XKB_STATE_MATCH_ANY = StateMatch.XKB_STATE_MATCH_ANY
+XKB_STATE_MATCH_ALL = StateMatch.XKB_STATE_MATCH_ALL
+XKB_STATE_MATCH_NON_EXCLUSIVE = StateMatch.XKB_STATE_MATCH_NON_EXCLUSIVE
+XKB_CONSUMED_MODE_XKB = ConsumedMode.XKB_CONSUMED_MODE_XKB
+XKB_CONSUMED_MODE_GTK = ConsumedMode.XKB_CONSUMED_MODE_GTK
+
+
+# Every possible StateComponent mask, indexed by value, so that state
+# updates don't have to construct a new flag instance each time.  The
+# components are the low bits of the mask, one bit each.
+_STATE_COMPONENTS = tuple(
+    StateComponent(i) for i in range(sum(StateComponent) + 1))
+_NUM_STATE_COMPONENTS = len(_STATE_COMPONENTS)
+
+
+def _state_component(value):
+    # Later libxkbcommon releases may report components we don't know
+    # about; those are kept as unknown bits, like StateComponent does
+    if value < _NUM_STATE_COMPONENTS:
+        return _STATE_COMPONENTS[value]
+    return StateComponent(value)
+
+
+# libxkbcommon functions called on every key event are bound to
+# module-level names to save an attribute lookup on lib per call
+_state_process_key = lib._state_process_key
+_xkb_state_update_key = lib.xkb_state_update_key
+_xkb_state_update_mask = lib.xkb_state_update_mask
+_xkb_state_key_get_syms = lib.xkb_state_key_get_syms
+_xkb_state_key_get_utf8 = lib.xkb_state_key_get_utf8
+_xkb_state_key_get_one_sym = lib.xkb_state_key_get_one_sym
+_xkb_state_key_get_consumed_mods2 = lib.xkb_state_key_get_consumed_mods2
+_xkb_state_serialize_mods = lib.xkb_state_serialize_mods
 
 
 class KeyboardState:
+    __slots__ = ('keymap', '_state', '_process_key_out', '_utf8_buf',
+                 '_syms_out', '_query_cache', '__weakref__')
+
     def __init__(self, keymap):
         state = lib.xkb_state_new(keymap._keymap)
         if not state:
             raise XKBError("Couldn't create keyboard state")
         # Keep the keymap around to ensure it isn't collected too soon
         self.keymap = keymap
-        self._state = ffi.gc(state, _keepref(lib, lib.xkb_state_unref))
+        self._state = ffi.gc(state, lib.xkb_state_unref)
+        # Output buffers for process_key(), key_get_string() and
+        # key_get_syms()
+        self._process_key_out = ffi.new("uint32_t[3]")
+        self._utf8_buf = ffi.new("char[64]")
+        self._syms_out = ffi.new("const xkb_keysym_t **")
+        # Results of the *_is_active(), serialize_*() and consumed
+        # modifier queries.  These only change when the state does, so
+        # the cache is emptied whenever update_key(), update_mask() or
+        # process_key() report a change.
+        self._query_cache = {}
 
     def get_keymap(self):
         """Get the Keymap which a keyboard state object is using.
@@ -774,8 +1034,30 @@ class KeyboardState:
         result of the update. If nothing in the state has changed,
         returns 0.
         """
-        return StateComponent(
-            lib.xkb_state_update_key(self._state, key, direction))
+        changed = _xkb_state_update_key(self._state, key, direction)
+        if changed:
+            self._query_cache.clear()
+        return _state_component(changed)
+
+    def process_key(self, key, direction):
+        """Look up a key and then update the keyboard state for it.
+
+        This combines KeyboardState.key_get_one_sym(),
+        xkb_state_key_get_utf32(), KeyboardState.key_get_consumed_mods()
+        and KeyboardState.update_key() in a single call into
+        libxkbcommon, for use when handling a key event.  The lookups
+        are made before the state is updated, which is the
+        conventional behaviour.
+
+        Returns a (keysym, utf32, consumed_mods, changed) tuple, where
+        utf32 is 0 if the key has no Unicode representation and
+        changed is the value that update_key() would return.
+        """
+        out = self._process_key_out
+        changed = _state_process_key(self._state, key, direction, out)
+        if changed:
+            self._query_cache.clear()
+        return out[0], out[1], out[2], _state_component(changed)
 
     def update_mask(self, depressed_mods, latched_mods, locked_mods,
                     depressed_layout, latched_layout, locked_layout):
@@ -801,9 +1083,12 @@ class KeyboardState:
         result of the update. If nothing in the state has changed,
         returns 0.
         """
-        return StateComponent(lib.xkb_state_update_mask(
+        changed = _xkb_state_update_mask(
             self._state, depressed_mods, latched_mods, locked_mods,
-            depressed_layout, latched_layout, locked_layout))
+            depressed_layout, latched_layout, locked_layout)
+        if changed:
+            self._query_cache.clear()
+        return _state_component(changed)
 
     def key_get_syms(self, key):
         """Get the keysyms obtained from pressing a particular key in a given
@@ -820,14 +1105,11 @@ class KeyboardState:
         This function does not perform any Keysym
         Transformations. (This might change).
         """
-        syms_out = ffi.new("const xkb_keysym_t **")
-        r = lib.xkb_state_key_get_syms(self._state, key, syms_out)
-        syms = []
-        if r > 0:
-            assert syms_out[0] != ffi.NULL
-        for i in range(0, r):
-            syms.append(syms_out[0][i])
-        return syms
+        syms_out = self._syms_out
+        r = _xkb_state_key_get_syms(self._state, key, syms_out)
+        if r <= 0:
+            return []
+        return list(syms_out[0][0:r])
 
     def key_get_string(self, key):
         """Get the Unicode/UTF-8 string obtained from pressing a particular
@@ -839,11 +1121,14 @@ class KeyboardState:
         Returns the string.  If there is nothing to return, returns
         the empty string.
         """
-        buffer = ffi.new("char[64]")
-        r = lib.xkb_state_key_get_utf8(self._state, key, buffer, len(buffer))
+        buffer = self._utf8_buf
+        r = _xkb_state_key_get_utf8(self._state, key, buffer, len(buffer))
         if r + 1 > len(buffer):
             raise XKBBufferTooSmall()
-        return ffi.string(buffer).decode('utf8')
+        if r == 1:
+            # A one byte UTF-8 sequence is always ASCII
+            return chr(ord(buffer[0]))
+        return ffi.string(buffer, r).decode('utf8')
 
     def key_get_one_sym(self, keycode):
         """Get the single keysym obtained from pressing a particular key in a
@@ -859,7 +1144,7 @@ class KeyboardState:
         Returns the keysym. If the key does not have exactly one
         keysym, returns lib.XKB_KEY_NoSymbol.
         """
-        return lib.xkb_state_key_get_one_sym(self._state, keycode)
+        return _xkb_state_key_get_one_sym(self._state, keycode)
 
     def key_get_layout(self, key):
         """Get the effective layout index for a key in a given keyboard state.
@@ -906,7 +1191,14 @@ class KeyboardState:
         This function should not be used in regular clients; please
         use the State.mod_*_is_active() API instead.
         """
-        return lib.xkb_state_serialize_mods(self._state, components)
+        cache_key = ("serialize_mods", components)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        r = _xkb_state_serialize_mods(self._state, components)
+        self._query_cache[cache_key] = r
+        return r
 
     def serialize_layout(self, components):
         """The counterpart to xkb_state_update_mask for layouts, to be used on
@@ -923,7 +1215,14 @@ class KeyboardState:
         This function should not be used in regular clients; please
         use the State.layout_*_is_active() API instead.
         """
-        return lib.xkb_state_serialize_layout(self._state, components)
+        cache_key = ("serialize_layout", components)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        r = lib.xkb_state_serialize_layout(self._state, components)
+        self._query_cache[cache_key] = r
+        return r
 
     def mod_name_is_active(self, name, type):
         """Test whether a modifier is active in a given keyboard state by
@@ -936,10 +1235,16 @@ class KeyboardState:
         If the modifier name does not exist in the keymap, raises
         XKBModifierDoesNotExist.
         """
-        r = lib.xkb_state_mod_name_is_active(self._state, name.encode(), type)
-        if r == -1:
-            raise XKBModifierDoesNotExist(name)
-        return r == 1
+        cache_key = ("mod_name", name, type)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        # Names are resolved through the keymap's index cache rather
+        # than having libxkbcommon look them up on every call
+        r = self.mod_index_is_active(self.keymap.mod_get_index(name), type)
+        self._query_cache[cache_key] = r
+        return r
 
     def mod_names_are_active(self, type, match, names):
         """Test whether a set of modifiers are active in a given keyboard
@@ -957,12 +1262,20 @@ class KeyboardState:
         not.  If any of the modifier names do not exist, raises
         XKBModifierDoesNotExist(None).
         """
-        args = [ffi.new("char []", n.encode('ascii')) for n in names]
-        args.append(ffi.NULL)
-        r = lib.xkb_state_mod_names_are_active(self._state, type, match, *args)
-        if r == -1:
-            raise XKBModifierDoesNotExist(None)
-        return r == 1
+        names = tuple(names)
+        cache_key = ("mod_names", type, match, names)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        mod_get_index = self.keymap.mod_get_index
+        try:
+            mods = [mod_get_index(n) for n in names]
+        except XKBModifierDoesNotExist:
+            raise XKBModifierDoesNotExist(None) from None
+        r = self.mod_indices_are_active(type, match, mods)
+        self._query_cache[cache_key] = r
+        return r
 
     def mod_index_is_active(self, idx, type):
         """Test whether a modifier is active in a given keyboard state by
@@ -972,10 +1285,41 @@ class KeyboardState:
         If the modifier index is invalid in the keymap, raises
         XKBInvalidModifierIndex.
         """
-        r = lib.xkb_state_mod_index_is_active(self._state, idx, type)
-        if r == -1:
+        cache_key = ("mod_index", idx, type)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        if not 0 <= idx < self.keymap._num_mods:
             raise XKBInvalidModifierIndex()
-        return r == 1
+        # A modifier is active exactly when its bit is set in the
+        # serialized state, which is cached until the state changes,
+        # so checking each modifier in turn only crosses into
+        # libxkbcommon once
+        mask = self.serialize_mods(type)
+        self._query_cache[cache_key] = r = bool(mask >> idx & 1)
+        return r
+
+    def active_mod_names(self, type):
+        """Get the names of all the modifiers active in a given keyboard
+        state.
+
+        type is the component of the state against which to match the
+        modifiers.
+
+        Returns a frozenset of modifier names.
+        """
+        cache_key = ("mod_names_active", type)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        mask = self.serialize_mods(type)
+        mod_get_name = self.keymap.mod_get_name
+        r = frozenset(mod_get_name(i) for i in range(self.keymap._num_mods)
+                      if mask >> i & 1)
+        self._query_cache[cache_key] = r
+        return r
 
     def mod_indices_are_active(self, type, match, mods):
         """Test whether a set of modifiers are active in a given keyboard
@@ -993,10 +1337,13 @@ class KeyboardState:
         not.  If any of the modifier indices are invalid in the
         keymap, raises XKBInvalidModifierIndex.
         """
-        args = [ffi.cast("int", x) for x in mods]
-        args.append(ffi.cast("int", lib.XKB_MOD_INVALID))
-        r = lib.xkb_state_mod_indices_are_active(
-            self._state, type, match, *args)
+        mods = list(mods)
+        try:
+            r = lib._state_mod_indices_are_active(
+                self._state, type, match, mods, len(mods))
+        except OverflowError:
+            # Negative, or too large for xkb_mod_index_t
+            raise XKBInvalidModifierIndex() from None
         if r == -1:
             raise XKBInvalidModifierIndex()
         return r == 1
@@ -1021,7 +1368,19 @@ class KeyboardState:
         Takes the given modifier mask, and removes all modifiers which
         are consumed for that particular key.
         """
-        return lib.xkb_state_mod_mask_remove_consumed(self._state, key, mask)
+        if not 0 <= mask <= 0xffffffff:
+            raise OverflowError("modifier mask out of range: %r" % mask)
+        # The modifiers kept for a key are found once by passing a full
+        # mask, which also preserves libxkbcommon's handling of
+        # invalid keycodes.
+        cache_key = ("kept_mods", key)
+        try:
+            kept = self._query_cache[cache_key]
+        except KeyError:
+            kept = lib.xkb_state_mod_mask_remove_consumed(
+                self._state, key, 0xffffffff)
+            self._query_cache[cache_key] = kept
+        return mask & kept
 
     def key_get_consumed_mods(self, key,
                               mode=ConsumedMode.XKB_CONSUMED_MODE_XKB):
@@ -1029,7 +1388,14 @@ class KeyboardState:
 
         Returns a mask of the consumed modifiers.
         """
-        return lib.xkb_state_key_get_consumed_mods2(self._state, key, mode)
+        cache_key = ("consumed_mods", key, mode)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        r = _xkb_state_key_get_consumed_mods2(self._state, key, mode)
+        self._query_cache[cache_key] = r
+        return r
 
     def layout_name_is_active(self, name, type):
         """Test whether a layout is active in a given keyboard state by name.
@@ -1041,11 +1407,15 @@ class KeyboardState:
         If multiple layouts in the keymap have this name, the one with
         the lowest index is tested.
         """
-        r = lib.xkb_state_layout_name_is_active(
-            self._state, name.encode(), type)
-        if r == -1:
-            raise XKBLayoutDoesNotExist(name)
-        return r == 1
+        cache_key = ("layout_name", name, type)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        r = self.layout_index_is_active(
+            self.keymap.layout_get_index(name), type)
+        self._query_cache[cache_key] = r
+        return r
 
     def layout_index_is_active(self, idx, type):
         """Test whether a layout is active in a given keyboard state by index.
@@ -1054,10 +1424,16 @@ class KeyboardState:
         the layout index is not valid in the keymap, raises
         XKBInvalidLayoutIndex.
         """
+        cache_key = ("layout_index", idx, type)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
         r = lib.xkb_state_layout_index_is_active(self._state, idx, type)
         if r == -1:
             raise XKBInvalidLayoutIndex()
-        return r == 1
+        self._query_cache[cache_key] = r = r == 1
+        return r
 
     def led_name_is_active(self, name):
         """Test whether a LED is active in a given keyboard state by name.
@@ -1066,10 +1442,14 @@ class KeyboardState:
         LED with this name exists in the keymap, raises
         XKBLEDDoesNotExist.
         """
-        r = lib.xkb_state_led_name_is_active(self._state, name.encode('ascii'))
-        if r == -1:
-            raise XKBLEDDoesNotExist(name)
-        return r == 1
+        cache_key = ("led_name", name)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        r = self.led_index_is_active(self.keymap.led_get_index(name))
+        self._query_cache[cache_key] = r
+        return r
 
     def led_index_is_active(self, idx):
         """Test whether a LED is active in a given keyboard state by index.
@@ -1078,7 +1458,20 @@ class KeyboardState:
         LED index is not valid in the keymap, raises
         XKBInvalidLEDIndex.
         """
-        r = lib.xkb_state_led_index_is_active(self._state, idx)
-        if r == -1:
-            raise XKBInvalidLEDIndex()
-        return r == 1
+        cache_key = ("led_index", idx)
+        try:
+            return self._query_cache[cache_key]
+        except KeyError:
+            pass
+        # Raises XKBInvalidLEDIndex in the same cases libxkbcommon
+        # would report the index as invalid
+        self.keymap.led_get_name(idx)
+        # Every LED is looked up at once, so that checking each of
+        # them in turn only crosses into libxkbcommon once
+        try:
+            mask = self._query_cache["led_mask"]
+        except KeyError:
+            mask = lib._state_led_mask(self._state)
+            self._query_cache["led_mask"] = mask
+        self._query_cache[cache_key] = r = bool(mask >> idx & 1)
+        return r